@@ -10,58 +10,51 @@ import matplotlib.pyplot as plt
 import networkx as nx
 import numpy as np
 import pandas
+import scipy.sparse
 
 from ContactNetwork import ContactNetwork
 
 with open('Airline_Jan_2013.csv', newline='') as csvfile:
     airline_data = pandas.read_csv(csvfile)
 
-# Formatting the Data
-airline_data = airline_data.iloc[1::2]
+# Formatting the Data, every other line of the file is empty. The passengers of all the flights
+# between the same airports are added up.
+airline_data = airline_data.dropna(how="all")
+airline_data = airline_data.groupby(["ORIGIN", "DEST"], sort=False, as_index=False)["PASSENGERS"].sum()
+airline_data = airline_data[airline_data["ORIGIN"] != airline_data["DEST"]]
 airport_nodes = set(airline_data["ORIGIN"].unique()).union(airline_data["DEST"].unique())
 num_nodes = len(airport_nodes)
 
-# Creating a matrix with r_ij values
-r = np.zeros([num_nodes, num_nodes])
-
 airport_nodes_map = dict([(node,i) for i,node in enumerate(airport_nodes)])
-origin = airline_data["ORIGIN"].map(airport_nodes_map).tolist()
-destination = airline_data["DEST"].map(airport_nodes_map).tolist()
-probabilities = airline_data["PASSENGERS"].to_numpy(dtype=float) / 80000#airline_data["PASSENGERS"].max()
-
-for i in range(len(origin)):
-    r[origin[i]][destination[i]] = probabilities[i]
-    r[destination[i]][origin[i]] = probabilities[i]
-
-for i in range(num_nodes):
-    r[i][i] = 1.0
+origin = airline_data["ORIGIN"].map(airport_nodes_map).to_numpy()
+destination = airline_data["DEST"].map(airport_nodes_map).to_numpy()
+# The passengers are scaled by the busiest airport pair. The 80000 scale used before the aggregation was
+# just above the largest single record, but the aggregated totals of some pairs go past it.
+passengers = airline_data["PASSENGERS"].to_numpy(dtype=np.float32)
+probabilities = passengers / passengers.max()
+
+# Creating a sparse matrix with r_ij values, and r_ii = 1.0. The graph is undirected, so r_ij = r_ji is the
+# probability of the busier of the two directions between the airports, the directions are not added up.
+directed = scipy.sparse.coo_matrix((probabilities, (origin, destination)),
+                                   shape=(num_nodes, num_nodes)).tocsr()
+r = directed.maximum(directed.T) + scipy.sparse.identity(num_nodes, dtype=np.float32, format="csr")
+r.eliminate_zeros()
 
 print("Average value of r_ij is ", r.sum()/len(origin))
 
 # Calculate the degrees
-degree = np.count_nonzero(r,axis=1)
+degree = np.diff(r.indptr)
 
 # Calculate the degree distribution
-dist = np.zeros(max(degree)+1)
-for i in degree:
-    dist[i] += 1
-
-# convert adjacency matrix into edge weights
-nodes_airport_map = dict([(i,node) for i,node in enumerate(airport_nodes)])
-edges = []
-
-idx = np.nonzero(r)
-for i in range(np.shape(idx)[1]):
-    a = idx[0][i]
-    b = idx[1][i]
-    if (a != b):
-        edges += [(nodes_airport_map[a], nodes_airport_map[b], {'weight': r[a][b]})]
+dist = np.bincount(degree)
 
-# creating a NetworkX graph with the set of edge weights
-g = nx.Graph(edges)
+# creating a NetworkX graph with the edge weights of the sparse matrix, without the r_ii self loops.
+# The nodes are the indices of the airports in airport_nodes_map.
+g = nx.from_scipy_sparse_array(r, edge_attribute='weight')
+g.remove_edges_from(nx.selfloop_edges(g))
 CN = ContactNetwork(g)
 
-infected_nodes = ['BKG', 'JAX', 'MLI', 'SWF', 'LCH']
+infected_nodes = [airport_nodes_map[airport] for airport in ['BKG', 'JAX', 'MLI', 'SWF', 'LCH']]
 stats = CN.collect_statistics(infected_nodes, 100)
 
 # plotting the number of exposed and infected nodes over time
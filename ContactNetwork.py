@@ -6,10 +6,14 @@ Created on Wed Jun 24 10:50:05 2020
 @author: azaldinfreidoon
 """
 
-from enum import Enum
-from Helper import Probability as Prob
+from enum import IntEnum
 from Helper import Distribution as Dist
+import copy
+import multiprocessing
+import networkx as nx
+import numba
 import numpy as np
+import scipy.sparse
 
 class ContactNetwork:
     """
@@ -25,9 +29,32 @@ class ContactNetwork:
     ----------
     graph : classes.graph.Graph
         NetworkX graph that is used to model the contact network.
+    node_idx : dict
+        Maps every node of the graph to its row in the CSR adjacency and the state arrays.
+    idx_node : list
+        Inverse of node_idx, the node that corresponds to every row.
+    indptr, indices, data : ndarray
+        CSR representation of the weighted adjacency matrix of the graph, with a row for every node
+        that spreads the infection.
+    log1m : Array of float32
+        log(1 - r_ij) for every stored edge weight, aligned with indices and data.
+    state : Array of int8
+        The state of every node, encoded with the values of the State inner class.
+    tcs : Array of int32
+        The time at which every node changed to its current state.
+    tau : int
+        The current time of the state of the entire contact network.
+    active : Array of int64
+        Indices of the infected and exposed nodes, the only nodes that can spread the infection.
+    method : str
+        How the exposure probabilities are computed, either "frontier" or "spmv".
+    device : str
+        Where the state arrays are stored and updated, either "cpu" or "cuda".
+    A_log : scipy.sparse.csr_matrix or cupyx.scipy.sparse.csr_matrix
+        Sparse matrix of log(1 - r_ij) used by the "spmv" method.
     """
     
-    def __init__(self, graph):
+    def __init__(self, graph, method=None, device="cpu"):
         """
         Constructor that initializes the contact network with the specified NetworkX graph.
 
@@ -36,14 +63,22 @@ class ContactNetwork:
         graph : classes.graph.Graph
             NetworkX graph that is used to model the contact network. The graph is deep copied and no changes
             made to the graph within this class implementation will affect the original graph. The graph must
-            have the weight attribute defined for all its edges. However, the state of the nodes, the time
-            the node changed state, and the time elapsed are all encoded as attributes to the nodes and graph,
-            respectively, by the algorithm.
+            have the weight attribute defined for all its edges. The weights are stored as a CSR adjacency
+            matrix, while the state of the nodes and the time the node changed state are stored in arrays
+            indexed by the rows of that matrix.
             
-            The 'tau' graph attribute is used to encode the current time of the state of the entire graph.
+            The tau attribute is used to encode the current time of the state of the entire graph.
             This allows us to look at every different iteration of the contact network modeling algorithm
             as working with a snapshot of the contact network graph. As such, this attribute is used by the
             _update() function to modify the states of the nodes.
+        method : str, optional
+            How the exposure probabilities are computed by _update(). "frontier" (the default on the cpu)
+            only visits the infected and exposed nodes and their susceptible neighbors with the compiled
+            _update_csr kernel. "spmv" (the default and only method on cuda) computes the exposure of every
+            node with a sparse matrix-vector product, which does not depend on the size of the active set.
+        device : str, optional
+            Either "cpu" or "cuda". With "cuda", the sparse matrix and the state arrays are stored on the
+            GPU with CuPy, which must be installed.
 
         Returns
         -------
@@ -51,13 +86,72 @@ class ContactNetwork:
 
         """
         self.graph = graph.copy()
-        self.graph.graph["tau"] = 0
-        for node in self.graph.nodes():
-            self._change_node_state(node, self.State.SUSCEPTIBLE)
+        self.idx_node = list(self.graph.nodes())
+        self.node_idx = dict((node, idx) for (idx, node) in enumerate(self.idx_node))
+        num_nodes = len(self.idx_node)
+        
+        # The rows are indexed by the node that spreads the infection (the transpose of the adjacency
+        # matrix of directed graphs) so that only the rows of infected and exposed nodes are visited
+        adjacency = nx.to_scipy_sparse_array(self.graph, nodelist=self.idx_node, weight="weight").T.tocsr()
+        self.indptr = adjacency.indptr
+        self.indices = adjacency.indices
+        self.data = adjacency.data
+        # The weights are probabilities, so they are clipped just below 1 to keep log(1 - r) finite. They
+        # are stored as float32, which is plenty for probabilities and halves the memory traffic of the
+        # exposure computation. The frontier kernel still accumulates the exposure in float64, while the spmv
+        # method computes it entirely in float32.
+        weights = self.data.astype(np.float32)
+        self.log1m = np.log1p(-np.clip(weights, 0, np.nextafter(np.float32(1), np.float32(0))))
+        
+        if device not in ("cpu", "cuda"):
+            raise ValueError("Unknown device: " + str(device))
+        if method is None:
+            method = "frontier" if device == "cpu" else "spmv"
+        if method not in ("frontier", "spmv"):
+            raise ValueError("Unknown method: " + str(method))
+        if method == "frontier" and device == "cuda":
+            raise ValueError("The frontier method is only available on the cpu")
+        self.method = method
+        self.device = device
+        xp = self.xp
+        if method == "spmv":
+            # log(1 - r_ij) with a row for every node that can be exposed
+            self.A_log = scipy.sparse.csr_matrix((self.log1m, self.indices, self.indptr),
+                                                 shape=(num_nodes, num_nodes)).T.tocsr()
+            if device == "cuda":
+                import cupyx.scipy.sparse
+                self.A_log = cupyx.scipy.sparse.csr_matrix(self.A_log)
+        
+        self.tau = 0
+        self.state = xp.full(num_nodes, self.State.SUSCEPTIBLE, dtype=xp.int8)
+        self.tcs = xp.zeros(num_nodes, dtype=xp.int32)
+        self.active = xp.zeros(0, dtype=xp.int64)
+        # buffers used by _update_csr to accumulate the exposure of the susceptible frontier
+        self._accum = np.zeros(num_nodes)
+        self._in_frontier = np.zeros(num_nodes, dtype=np.bool_)
+    
+    @property
+    def xp(self):
+        """
+        The array module of the device of the contact network, numpy on the cpu and cupy on cuda.
+        """
+        if self.device == "cuda":
+            import cupy
+            return cupy
+        return np
+    
+    def _to_host(self, array):
+        """
+        Returns the array as a numpy array, copying it from the GPU if needed.
+        """
+        if self.device == "cuda":
+            return array.get()
+        return array
     
-    class State(Enum):
+    class State(IntEnum):
         """
-        This is an ENUM nested class that encodes the different states of a node in an SEIR model.
+        This is an IntEnum nested class that encodes the different states of a node in an SEIR model.
+        The members are integers, so they are compared to and stored in the state array directly.
         """
         SUSCEPTIBLE = 0
         INFECTED = 1
@@ -68,17 +162,17 @@ class ContactNetwork:
         """
         Changes the state of the node.
         
-        The state of the node is encoded as node attributes in the networkx graph. Similarily, the time that
-        has elapsed is encoded as an attribute to the graph itself. It is used to determine the time at which
-        the node has changed states. When updating the state attribute of the node, we need to encode the time
-        the node changed state because the rate at which it infects other nodes increases starting from the
-        time the node changed states.
+        The state of the node is stored in the state array at the index of the node. Similarily, the time
+        that has elapsed is stored in the tau attribute. It is used to determine the time at which the node
+        has changed states. When updating the state of the node, we need to record the time the node changed
+        state because the rate at which it infects other nodes increases starting from the time the node
+        changed states. The set of active nodes is kept up to date as well.
 
         Parameters
         ----------
         node : Any hashable python object except None.
             This is the object that exists in the NetworkX node dictionary.
-        state : Enum
+        state : IntEnum
             This is the state of the node as defined by the State inner class.
 
         Returns
@@ -86,8 +180,31 @@ class ContactNetwork:
         None.
 
         """
-        self.graph.nodes[node]["state"] = state
-        self.graph.nodes[node]["time_changed_state"] = self.graph.graph["tau"]
+        self._change_nodes_state([node], state)
+    
+    def _change_nodes_state(self, nodes, state):
+        """
+        Changes the state of several nodes at once.
+        
+        The nodes are mapped to their indices once, and the state and tcs arrays as well as the set of
+        active nodes are then updated with a single array operation each.
+
+        Parameters
+        ----------
+        nodes : list of any hashable python objects except None.
+            These are the objects that exist in the NetworkX node dictionary.
+        state : IntEnum
+            This is the state of the nodes as defined by the State inner class.
+
+        Returns
+        -------
+        None.
+
+        """
+        idx = self.xp.asarray([self.node_idx[node] for node in nodes], dtype=self.xp.int64)
+        self.state[idx] = state
+        self.tcs[idx] = self.tau
+        self.active = self.xp.flatnonzero((self.state == _INFECTED) | (self.state == _EXPOSED))
     
     def _get_node_state(self, node):
         """
@@ -100,16 +217,50 @@ class ContactNetwork:
 
         Returns
         -------
-        Enum
+        IntEnum
             This is the state of the node as defined by the State inner class.
 
         """
-        return self.graph.nodes[node]["state"]
+        return self.State(int(self.state[self.node_idx[node]]))
     
-    def model_contact_network(self, infected_nodes, num_iterations):
+    def step(self):
+        """
+        Advances the model by one iteration.
+
+        Returns
+        -------
+        changed : Array of int64
+            Indices of the nodes that changed state, as returned by _update().
+
+        """
+        return self._update()
+    
+    def run(self, infected_nodes, num_iterations):
+        """
+        Models the graph associated with this instance of the class with the specified number of iterations
+        and starting set of infected nodes, without any output or pause between iterations.
+
+        Parameters
+        ----------
+        infected_nodes : list of any hashable python objects except None.
+            List of initially infected nodes.
+        num_iterations : int
+            The specified number of iterations for which the algorithm will run.
+
+        Returns
+        -------
+        None.
+
+        """
+        self._change_nodes_state(infected_nodes, self.State.INFECTED)
+        for tau in range(num_iterations):
+            self._update()
+    
+    def run_interactive(self, infected_nodes, num_iterations):
         """
         Begins modeling the graph associated with this instance of the class with the specified number of
-        iterations and starting set of infected nodes.
+        iterations and starting set of infected nodes, printing the modified nodes and waiting for the enter
+        key at the end of every iteration.
 
         Parameters
         ----------
@@ -123,24 +274,43 @@ class ContactNetwork:
         None.
 
         """
-        for node in infected_nodes:
-            self._change_node_state(node, self.State.INFECTED)
+        self._change_nodes_state(infected_nodes, self.State.INFECTED)
         
         print("Press enter to advance at the end of every iteration")
         for tau in range(num_iterations):
             print("Time:", tau)
-            modified_node_states = self._update()
-            for node, state in modified_node_states.items():
-                print("node:", node, "->", state)
+            for idx in self._update():
+                node = self.idx_node[idx]
+                print("node:", node, "->", self._get_node_state(node).name)
             input()
     
+    def model_contact_network(self, infected_nodes, num_iterations):
+        """
+        Same as run(), kept for existing scripts. It no longer prints the modified nodes or waits for the
+        enter key at every iteration, use run_interactive() for that.
+
+        Parameters
+        ----------
+        infected_nodes : list of any hashable python objects except None.
+            List of initially infected nodes.
+        num_iterations : int
+            The specified number of iterations for which the algorithm will run.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.run(infected_nodes, num_iterations)
+    
     def collect_statistics(self, infected_nodes, num_iterations):
         """
         Tracks the states of the nodes in the graph for every iteration.
         
         The returned matrix contains three rows corresponding to exposed, infected and recovered nodes.
-        Each element in the row is the total number of nodes that belong to that state at that iteration.
-        The susceptible row was omitted since it can easily be derived from the first three rows.
+        Each element in the row is the total number of nodes that belong to that state at that iteration,
+        counted directly from the state array. The susceptible row was omitted since it can easily be
+        derived from the first three rows.
 
         Parameters
         ----------
@@ -155,35 +325,78 @@ class ContactNetwork:
             numpy ndarray with (3, num_iterations) shape and float64 type.
 
         """
-        for node in infected_nodes:
-            self._change_node_state(node, self.State.INFECTED)
+        self._change_nodes_state(infected_nodes, self.State.INFECTED)
         
         stats = np.zeros([3, num_iterations+1])
-        state_map = dict({
-            self.State.EXPOSED: 0,
-            self.State.INFECTED: 1,
-            self.State.RECOVERED: 2
-        })
+        # position of the exposed, infected and recovered counts in the bincount of the state array
+        state_rows = [self.State.EXPOSED, self.State.INFECTED, self.State.RECOVERED]
         
-        stats[state_map[self.State.INFECTED]][0] = len(infected_nodes)
+        stats[:, 0] = self._to_host(self.xp.bincount(self.state, minlength=len(self.State)))[state_rows]
         
         for tau in range(1, num_iterations+1):
-            modified_node_states = self._update()
-            
-            total_nodes_modified = [0,0,0]
-            for node in modified_node_states:
-                state = modified_node_states[node]
-                total_nodes_modified[state_map[state]] += 1
-            
-            idx_e = state_map[self.State.EXPOSED]
-            idx_i = state_map[self.State.INFECTED]
-            idx_r = state_map[self.State.RECOVERED]
-            stats[idx_e][tau] = stats[idx_e][tau-1] + total_nodes_modified[idx_e] - total_nodes_modified[idx_i]
-            stats[idx_i][tau] = stats[idx_i][tau-1] + total_nodes_modified[idx_i] - total_nodes_modified[idx_r]
-            stats[idx_r][tau] = stats[idx_r][tau-1] + total_nodes_modified[idx_r]
+            self._update()
+            stats[:, tau] = self._to_host(self.xp.bincount(self.state, minlength=len(self.State)))[state_rows]
         
         return stats
     
+    def collect_statistics_parallel(self, infected_nodes, num_iterations, num_runs, n_workers=None,
+                                    seed=None):
+        """
+        Runs collect_statistics for several independent simulations in parallel.
+        
+        Every worker process receives the contact network once, and every run is simulated on a copy of it
+        that shares the graph and the CSR arrays but has its own node states, with its own random seed.
+        The state of this instance is not modified. Only contact networks on the cpu can be used, since the
+        CUDA state of cupy does not survive forking the worker processes.
+
+        Parameters
+        ----------
+        infected_nodes : list of any hashable python objects except None.
+            List of initially infected nodes.
+        num_iterations : int
+            The specified number of iterations for which the algorithm will run.
+        num_runs : int
+            Number of independent simulations.
+        n_workers : int, optional
+            Number of worker processes. Defaults to the number of CPUs.
+        seed : int, optional
+            Seed used to generate the seeds of the simulations.
+
+        Returns
+        -------
+        stats : Array of float64
+            numpy ndarray with (num_runs, 3, num_iterations+1) shape and float64 type, the statistics of
+            every simulation as returned by collect_statistics.
+
+        """
+        if self.device != "cpu":
+            raise ValueError("Parallel statistics are only available on the cpu")
+        if num_runs == 0:
+            return np.zeros([0, 3, num_iterations+1])
+        seeds = np.random.SeedSequence(seed).generate_state(num_runs)
+        with multiprocessing.Pool(n_workers, initializer=_init_worker, initargs=(self,)) as pool:
+            stats = pool.starmap(_run_once, [(s, infected_nodes, num_iterations) for s in seeds])
+        return np.stack(stats)
+    
+    def _copy(self):
+        """
+        Returns a copy of the contact network that shares the graph and the CSR arrays, which are never
+        modified, but has its own node states.
+
+        Returns
+        -------
+        ContactNetwork
+            The copy of the contact network.
+
+        """
+        network = copy.copy(self)
+        network.state = self.state.copy()
+        network.tcs = self.tcs.copy()
+        network.active = self.active.copy()
+        network._accum = self._accum.copy()
+        network._in_frontier = self._in_frontier.copy()
+        return network
+    
     def get_animation_func(self, infected_nodes, *artists):
         """
         Returns the func used to animate networkx graphs using FuncAnimation from Matplotlib.animation.
@@ -195,8 +408,9 @@ class ContactNetwork:
         ----------
         infected_nodes : list of any hashable python objects except None.
             List of initially infected nodes.
-        *artists : collections.PathCollection and collections.LineCollection objects
-            The artist objects that represent the nodes and the edges.
+        *artists : collections.PathCollection, collections.LineCollection and text.Text objects
+            The artist objects that represent the nodes, the edges and the day counter, followed by any
+            other artists (e.g. node labels) that have to be redrawn every frame when blitting.
 
         Returns
         -------
@@ -207,23 +421,19 @@ class ContactNetwork:
         nodes = artists[0]
         text = artists[2]
         
-        for node in infected_nodes:
-            self._change_node_state(node, self.State.INFECTED)
+        self._change_nodes_state(infected_nodes, self.State.INFECTED)
         
-        def _get_node_color(node):
-            return {self.State.SUSCEPTIBLE: "#0000ff",
-                    self.State.INFECTED: "#ff0000",
-                    self.State.RECOVERED: "#00ff00",
-                    self.State.EXPOSED: "#ffa500"}[self.graph.nodes[node]["state"]]
+        state_color = {self.State.SUSCEPTIBLE: "#0000ff",
+                       self.State.INFECTED: "#ff0000",
+                       self.State.RECOVERED: "#00ff00",
+                       self.State.EXPOSED: "#ffa500"}
         
-        idx = dict((node, idx) for (idx, node) in enumerate(self.graph.nodes()))
-        colors = [_get_node_color(node) for node in self.graph.nodes()]
+        # colors indexed by the values of the states, so the colors of all the nodes are a single lookup
+        color_by_state = np.array([state_color[self.State(value)] for value in range(len(self.State))],
+                                  dtype=object)
         def animate(frame):
-            modified_node_states = self._update()
-            for node in modified_node_states:
-                color = _get_node_color(node)
-                colors[idx[node]] = color
-            nodes.set_facecolor(colors)
+            self._update()
+            nodes.set_facecolor(color_by_state[self._to_host(self.state)])
             text.set_text("Day " + str(frame))
             return artists
         return animate
@@ -233,43 +443,224 @@ class ContactNetwork:
         Updates the graph based on the states of the nodes, weights of the edges, and the current time
         attribute of the graph.
 
+        The transitions are computed by the compiled _accumulate_exposure and _update_csr kernels, or by
+        _update_spmv depending on the method of the contact network. Since the kernels cannot call the
+        Helper distributions, the thresholds are sampled beforehand and passed as arrays. The kernels only
+        need a recovery and an infection threshold for every active node and an exposure threshold for
+        every node of the susceptible frontier, so only those are sampled, in one call per distribution.
+
         Returns
         -------
-        modified_node_states : dict
-            A dictionary that maps all the nodes that were modified to the their respective modified state.
+        changed : Array of int64
+            numpy array with the indices of the nodes that were modified. The node of an index is given by
+            idx_node and its new state by the state array.
 
         """
+        if self.method == "spmv":
+            xp = self.xp
+            num_nodes = len(self.state)
+            changed = self._update_spmv(xp.asarray(Dist.sampleRecoveryDistribution(size=num_nodes)),
+                                        xp.asarray(Dist.sampleInfectionDistribution(size=num_nodes)),
+                                        xp.asarray(Dist.sampleExposureDistribution(size=num_nodes)))
+        else:
+            frontier = _accumulate_exposure(self.indptr, self.indices, self.log1m, self.state, self.tcs,
+                                            self.tau, self.active, self._accum, self._in_frontier)
+            num_active = len(self.active)
+            changed, self.active = _update_csr(self.state, self.tcs, self.tau, self.active, frontier,
+                                               self._accum, self._in_frontier,
+                                               Dist.sampleRecoveryDistribution(size=num_active),
+                                               Dist.sampleInfectionDistribution(size=num_active),
+                                               Dist.sampleExposureDistribution(size=len(frontier)))
+        self.tau += 1
+        return self._to_host(changed)
+    
+    def _update_spmv(self, rec_thresh, inf_thresh, exp_thresh):
+        """
+        Applies one iteration of the SEIR model to the state arrays with array operations.
         
+        The exponent of the exposure probability of every node,
+            sum_j (tau - t_j) * log(1 - r_ij)
+        over its infected and exposed neighbors j, is the product of A_log with the vector of the time
+        elapsed since every active node changed state (zero for the other nodes), so one sparse
+        matrix-vector product replaces the loop over the neighbors of the active nodes. The same code runs
+        on the GPU, since cupy and cupyx.scipy.sparse mirror the numpy and scipy.sparse interfaces.
+
+        Parameters
+        ----------
+        rec_thresh, inf_thresh, exp_thresh : Array of float64
+            Samples of the recovery, infection and exposure distributions for every node, on the device
+            of the contact network.
+
+        Returns
+        -------
+        changed : Array of int64
+            Indices of the nodes that changed state.
+
         """
-        TODO: Optimize this so that we are not traversing all nodes. Can be
-        done by only checking non_susceptible nodes and their neighbors.
-        """
-        tau = self.graph.graph["tau"]
-        # modified node states is used to prevent having changed node states affect the current iteration
-        modified_node_states = dict()
-        for node in self.graph.nodes():
-            state = self._get_node_state(node)
-            if (state == self.State.INFECTED):
-                if (tau - self.graph.nodes[node]["time_changed_state"] >= Dist.sampleRecoveryDistribution()):
-                    modified_node_states[node] = self.State.RECOVERED
-            elif (state == self.State.SUSCEPTIBLE):
-                # Find all adjacent edges to the susceptible node connected to exposed or infected
-                # nodes. Creates a tuple with the weight of the edge and the time the node changed
-                # state of the connected infected or exposed node.
-                edges = [(self.graph[node][n]['weight'], self.graph.nodes[n]['time_changed_state'])
-                           for n in self.graph.neighbors(node) if
-                                   ((self._get_node_state(n) == self.State.INFECTED) or
-                                   (self._get_node_state(n) == self.State.EXPOSED))
-                        ]
-                T = lambda r, t: 1 - (1 - r)**(tau - t)
-                z = Prob.unionProbability([T(r,t) for (r,t) in edges])
-                if (z >= Dist.sampleExposureDistribution()):
-                    modified_node_states[node] = self.State.EXPOSED
-            elif (state == self.State.EXPOSED):
-                if (tau - self.graph.nodes[node]["time_changed_state"] >= Dist.sampleInfectionDistribution()):
-                    modified_node_states[node] = self.State.INFECTED
-        # apply all the modifications to the networkx graph
-        for node in modified_node_states:
-            self._change_node_state(node, modified_node_states[node])
-        self.graph.graph["tau"] += 1
-        return modified_node_states
\ No newline at end of file
+        xp = self.xp
+        elapsed = self.tau - self.tcs
+        susceptible = self.state == _SUSCEPTIBLE
+        infected = self.state == _INFECTED
+        exposed = self.state == _EXPOSED
+        
+        # delta has the float32 type of A_log so the product is computed and accumulated in float32, a
+        # float64 delta would make the sparse product upcast a copy of A_log every iteration
+        delta = xp.where(infected | exposed, elapsed, 0).astype(self.log1m.dtype)
+        probability = -xp.expm1(self.A_log @ delta)
+        
+        # the next states are computed from the current states so that changed node states do not affect
+        # the current iteration, and swapped in at once
+        next_state = xp.where(infected & (elapsed >= rec_thresh), _RECOVERED,
+                              xp.where(susceptible & (probability >= exp_thresh), _EXPOSED,
+                                       xp.where(exposed & (elapsed >= inf_thresh), _INFECTED, self.state)))
+        changed = xp.flatnonzero(next_state != self.state)
+        self.state = next_state.astype(xp.int8, copy=False)
+        self.tcs[changed] = self.tau
+        self.active = xp.flatnonzero((self.state == _INFECTED) | (self.state == _EXPOSED))
+        return changed
+
+
+# contact network of the worker processes of collect_statistics_parallel
+_worker_network = None
+
+
+def _init_worker(network):
+    """
+    Stores the contact network in the worker process so it is only sent once to every worker.
+    """
+    global _worker_network
+    _worker_network = network
+
+
+def _run_once(seed, infected_nodes, num_iterations):
+    """
+    Runs one simulation of collect_statistics_parallel on a copy of the contact network of the worker.
+    """
+    Dist.seed(seed)
+    return _worker_network._copy().collect_statistics(infected_nodes, num_iterations)
+
+
+# plain integer states used by the compiled kernels
+_SUSCEPTIBLE = int(ContactNetwork.State.SUSCEPTIBLE)
+_INFECTED = int(ContactNetwork.State.INFECTED)
+_RECOVERED = int(ContactNetwork.State.RECOVERED)
+_EXPOSED = int(ContactNetwork.State.EXPOSED)
+
+
+@numba.njit(cache=True, fastmath=True)
+def _accumulate_exposure(indptr, indices, log1m_data, state, tcs, tau, active, accum, in_frontier):
+    """
+    Computes the exponent of the exposure probability of the susceptible neighbors of the active nodes.
+
+    The exposure probability of a susceptible node i is the union probability of being exposed by its
+    infected or exposed neighbors j,
+        p_i = 1 - prod_j (1 - r_ij)^(tau - t_j) = 1 - exp(sum_j (tau - t_j) * log(1 - r_ij))
+    which is a generalized (1 - .)(.) sparse matrix-vector product. The logarithms are computed once
+    when the network is created, so every edge only costs a multiplication and every node a single
+    expm1, which unlike 1 - exp keeps its precision for small probabilities. Only the rows of the active
+    nodes are visited, and their contributions are scattered to their susceptible neighbors, so the work
+    done is proportional to the number of edges of the active nodes rather than the size of the graph.
+
+    Parameters
+    ----------
+    indptr, indices : ndarray
+        CSR structure of the adjacency matrix, with a row for every node that spreads the infection.
+    log1m_data : Array of float32
+        log(1 - r_ij) for every stored edge.
+    state : Array of int8
+        The state of every node.
+    tcs : Array of int32
+        The time at which every node changed to its current state.
+    tau : int
+        The current time.
+    active : Array of int64
+        Indices of the infected and exposed nodes.
+    accum : Array of float64
+        Zeroed buffer that receives sum_j (tau - t_j) * log(1 - r_ij) for the nodes of the frontier.
+    in_frontier : Array of bool
+        Cleared buffer used to mark the nodes of the frontier.
+
+    Returns
+    -------
+    frontier : Array of int64
+        Indices of the susceptible nodes adjacent to at least one active node.
+
+    """
+    frontier = np.empty(state.shape[0], dtype=np.int64)
+    num_frontier = 0
+    for j in active:
+        elapsed = tau - tcs[j]
+        for k in range(indptr[j], indptr[j+1]):
+            i = indices[k]
+            if state[i] == _SUSCEPTIBLE:
+                if not in_frontier[i]:
+                    in_frontier[i] = True
+                    frontier[num_frontier] = i
+                    num_frontier += 1
+                accum[i] += elapsed * log1m_data[k]
+    return frontier[:num_frontier]
+
+
+@numba.njit(cache=True, fastmath=True)
+def _update_csr(state, tcs, tau, active, frontier, accum, in_frontier, rec_thresh, inf_thresh, exp_thresh):
+    """
+    Applies one iteration of the SEIR model to the state arrays in place.
+
+    Only the active nodes and their susceptible neighbors can change state, so no other node is
+    visited. The exposure of the frontier must have been accumulated by _accumulate_exposure before any
+    node is modified, so changed node states do not affect the current iteration. The accum and
+    in_frontier buffers are cleared again before returning.
+
+    Parameters
+    ----------
+    state, tcs, tau, active, accum, in_frontier
+        See _accumulate_exposure.
+    frontier : Array of int64
+        The susceptible frontier returned by _accumulate_exposure.
+    rec_thresh : Array of float64
+        Sample of the recovery distribution for every active node.
+    inf_thresh : Array of float64
+        Sample of the infection distribution for every active node.
+    exp_thresh : Array of float64
+        Sample of the exposure distribution for every node of the frontier.
+
+    Returns
+    -------
+    changed : Array of int64
+        Indices of the nodes that changed state.
+    next_active : Array of int64
+        Indices of the infected and exposed nodes after the iteration.
+
+    """
+    changed = np.empty(active.shape[0] + frontier.shape[0], dtype=np.int64)
+    next_active = np.empty(active.shape[0] + frontier.shape[0], dtype=np.int64)
+    num_changed = 0
+    num_active = 0
+    for a in range(active.shape[0]):
+        j = active[a]
+        elapsed = tau - tcs[j]
+        if state[j] == _INFECTED and elapsed >= rec_thresh[a]:
+            state[j] = _RECOVERED
+        elif state[j] == _EXPOSED and elapsed >= inf_thresh[a]:
+            state[j] = _INFECTED
+            next_active[num_active] = j
+            num_active += 1
+        else:
+            next_active[num_active] = j
+            num_active += 1
+            continue
+        tcs[j] = tau
+        changed[num_changed] = j
+        num_changed += 1
+    for f in range(frontier.shape[0]):
+        i = frontier[f]
+        if -np.expm1(accum[i]) >= exp_thresh[f]:
+            state[i] = _EXPOSED
+            tcs[i] = tau
+            changed[num_changed] = i
+            num_changed += 1
+            next_active[num_active] = i
+            num_active += 1
+        accum[i] = 0.0
+        in_frontier[i] = False
+    return changed[:num_changed], next_active[:num_active]
@@ -6,8 +6,13 @@ Created on Thu Jun 25 07:11:40 2020
 @author: azaldinfreidoon
 """
 
+import functools
+
+import numba
 import numpy as np
-from itertools import combinations
+
+# random number generator shared by the distributions, see Distribution.seed
+_RNG = np.random.default_rng()
 
 class Probability:
     """
@@ -22,6 +27,12 @@ class Probability:
         We assume that all the events are independent. The joint probability is calculated
         by taking the product of all the corresponding probabilities of the independent events.
 
+        The product is taken in float32, which moves half the memory of float64. Values near 1 are only
+        resolved to an absolute error of about 1e-7 (not a relative one), which is enough for probabilities
+        but not for subtracting the product from 1, see unionProbability. Small tuples and lists (fewer than 16
+        probabilities) of scalars are memoized by _cached_joint_probability, since the same small sets of
+        probabilities tend to repeat.
+
         Parameters
         ----------
         e : array_like
@@ -29,11 +40,17 @@ class Probability:
 
         Returns
         -------
-        product : depends on the types of the elements of e
+        product : float32
             Product of all probabilities of all the independent events.
 
         """
-        return np.prod(e)
+        if isinstance(e, (tuple, list)) and len(e) < 16:
+            try:
+                return _cached_joint_probability(tuple(e))
+            except TypeError:
+                # unhashable elements, e.g. nested lists or arrays, are not cached
+                pass
+        return np.prod(np.asarray(e, dtype=np.float32))
     
     @staticmethod
     def unionProbability(e):
@@ -48,6 +65,11 @@ class Probability:
         
         However, this is equivalent to
             P(A+B) = 1 - (1-P(A))*(1-P(B))
+        which only takes n multiplications instead of the 2^n terms of the expansion above, so the
+        expansion is never computed. It is computed in float32 as
+            1 - prod(1 - p) = -expm1(sum(log1p(-p)))
+        because the products of the complements are close to 1 for small probabilities, and subtracting
+        them from 1 in float32 would cancel to 0 below an absolute error of about 1e-7.
 
         Parameters
         ----------
@@ -56,17 +78,51 @@ class Probability:
 
         Returns
         -------
-        union probability : depends on the types of the elements of e
+        union probability : float32
             The union probability of the independent events.
 
         """
-        return 1 - Probability.jointProbability([1-x for x in e])
+        # a probability of 1 gives log1p(-1) = -inf and a union probability of 1
+        with np.errstate(divide="ignore"):
+            return -np.expm1(np.sum(np.log1p(-np.asarray(e, dtype=np.float32))))
+    
+    @staticmethod
+    def unionProbabilityBatch(P, mask=None):
+        """
+        Calculates the union probabilities of many sets of independent events at once.
+        
+        Every row of P holds the probabilities of one set of events, padded to the length of the longest
+        set. The padding is excluded with the mask, which is 1 for the events of the set and 0 for the
+        padding. The rows are computed in float32 by the compiled gufunc built by _union_gu.
+
+        Parameters
+        ----------
+        P : array_like
+            2D array with the probabilities of the events of every set, one set per row.
+        mask : array_like, optional
+            Array with the same shape as P, 1 for events and 0 for padding. Every event is included if
+            None.
+
+        Returns
+        -------
+        union probabilities : Array of float32
+            The union probability of the events of every row.
+
+        """
+        P = np.asarray(P, dtype=np.float32)
+        mask = np.ones_like(P) if mask is None else np.asarray(mask, dtype=np.float32)
+        with np.errstate(divide="ignore"):
+            return _union_gu()(P, mask)
     
     @staticmethod
     def millers_algorithm(e):
         """
         Implementation of Miller's algorithm of computing union probabilities of independent events
         
+        The algorithm itself is compiled with Numba in _miller_core. Unlike jointProbability and
+        unionProbability it stays in float64, because its alternating sums cancel and would lose most of
+        the digits of float32.
+        
         Reference:
             Miller, G. D. (1968). Programming Techniques: An algorithm for the probability of the union
                 of a large number of events. Communications of the ACM, 11(9), 630-631.
@@ -83,61 +139,243 @@ class Probability:
             The union probability of the independent events.
 
         """
-        n = len(e)
-        prob = np.array([e]).T
-        prev = prob
-        res = prev.sum()
-        for r in range(2, n+1):
-            size = n-r+1
-            u = np.triu(np.ones([size]*2),0)
-            prev = np.matmul(u, prev[1:]) * prob[0:size]
-            res += ((-1)**(r-1)) * prev.sum()
-        return res
+        return _miller_core(np.ascontiguousarray(e, dtype=np.float64))
+
+
+class _PoolRNG:
+    """
+    Pool of samples of a normal distribution that are drawn a chunk at a time from the module level
+    Generator and handed out one at a time.
+    """
+    
+    def __init__(self, mean, std, chunk=4096, low=None, high=None):
+        """
+        Constructor that initializes an empty pool.
+
+        Parameters
+        ----------
+        mean : float
+            Mean of the normal distribution.
+        std : float
+            Standard deviation of the normal distribution.
+        chunk : int, optional
+            Number of samples drawn every time the pool is empty.
+        low, high : float, optional
+            Bounds the samples are clipped to, if given.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.mean = mean
+        self.std = std
+        self.chunk = chunk
+        self.low = low
+        self.high = high
+        self.reset()
+    
+    def reset(self):
+        """
+        Discards the samples left in the pool, so the next sample is drawn from the current Generator.
+        """
+        self.buf = []
+        self.i = 0
+    
+    def next(self):
+        """
+        Returns the next sample of the pool, refilling it first if it is empty.
+
+        Returns
+        -------
+        sample : float
+            Sample from the normal distribution.
+
+        """
+        if self.i == len(self.buf):
+            sample = _RNG.normal(self.mean, self.std, self.chunk)
+            if self.low is not None:
+                np.clip(sample, self.low, self.high, out=sample)
+            # a list of floats is faster to index than an array and returns python floats
+            self.buf = sample.tolist()
+            self.i = 0
+        self.i += 1
+        return self.buf[self.i-1]
 
 
 class Distribution:
     """
     This is a class that implements the different normal distributions used in a contact network.
+    
+    All the distributions are sampled from the same module level numpy Generator, which draws a whole
+    array of samples in one call when size is given. Single samples are handed out from pools that are
+    refilled a chunk at a time, so the generator is not called for every sample.
     """
     
     @staticmethod
-    def sampleRecoveryDistribution():
+    def seed(seed=None):
+        """
+        Reseeds the random number generator used by all the distributions.
+
+        Parameters
+        ----------
+        seed : int, optional
+            Seed of the new generator. Fresh entropy from the OS is used if None.
+
+        Returns
+        -------
+        None.
+
+        """
+        global _RNG
+        _RNG = np.random.default_rng(seed)
+        for pool in (_recovery_pool, _exposure_pool, _infection_pool):
+            pool.reset()
+    
+    @staticmethod
+    def sampleRecoveryDistribution(size=None):
         """
         Samples the recovery normal distribution, which has a mean of 14 days and a standard
         deviation of 1 day.
 
+        Parameters
+        ----------
+        size : int, optional
+            Number of samples to draw. A single sample is drawn if None.
+
         Returns
         -------
-        sample: scalar
+        sample: scalar or ndarray
             Sample from the normal distribution.
 
         """
-        return np.random.normal(14,1)
+        if size is None:
+            return _recovery_pool.next()
+        return _RNG.normal(14,1,size)
     
     @staticmethod
-    def sampleExposureDistribution():
+    def sampleExposureDistribution(size=None):
         """
         Samples the exposure normal distribution, which has a mean of 0.97 and a standard deviation
         of 0.1. The values are bounded by 0 and 1.
 
+        Parameters
+        ----------
+        size : int, optional
+            Number of samples to draw. A single sample is drawn if None.
+
         Returns
         -------
-        sample: scalar
+        sample: scalar or ndarray
             Sample from the normal distribution.
 
         """
-        return max(0, min(1, np.random.normal(0.97, 0.1)))
+        if size is None:
+            return _exposure_pool.next()
+        sample = _RNG.normal(0.97, 0.1, size)
+        # clipped in place to avoid allocating a second array
+        return np.clip(sample, 0, 1, out=sample)
     
     @staticmethod
-    def sampleInfectionDistribution():
+    def sampleInfectionDistribution(size=None):
         """
         Samples the infectious rate normal distribution, which has a mean of 9 days and a standard deviation
         of 2 days.
 
+        Parameters
+        ----------
+        size : int, optional
+            Number of samples to draw. A single sample is drawn if None.
+
         Returns
         -------
-        sample: scalar
+        sample: scalar or ndarray
             Sample from the normal distribution.
 
         """
-        return np.random.normal(9,2)
\ No newline at end of file
+        if size is None:
+            return _infection_pool.next()
+        return _RNG.normal(9,2,size)
+
+
+# pools of single samples of the distributions
+_recovery_pool = _PoolRNG(14, 1)
+_exposure_pool = _PoolRNG(0.97, 0.1, low=0, high=1)
+_infection_pool = _PoolRNG(9, 2)
+
+
+@functools.lru_cache(maxsize=8192)
+def _cached_joint_probability(e):
+    """
+    Memoized product of a small tuple of probabilities, see Probability.jointProbability.
+    """
+    return np.prod(np.asarray(e, dtype=np.float32))
+
+
+@numba.njit(cache=True, fastmath=True)
+def _miller_core(p):
+    """
+    Compiled loop of Probability.millers_algorithm.
+    
+    The r-th term of the algorithm is obtained from the previous one by multiplying the reverse cumulative
+    sum of the previous terms with the probabilities. The reverse cumulative sum is computed in place in
+    the same buffer, so no temporary arrays are allocated. The terms shrink multiplicatively with r, so
+    once they have all underflowed to zero the remaining terms are zero too and the loop stops early.
+
+    Parameters
+    ----------
+    p : Array of float64
+        Contiguous array of the probabilities of all the independent events.
+
+    Returns
+    -------
+    union probability : float64
+        The union probability of the independent events.
+
+    """
+    n = p.shape[0]
+    prev = p.copy()
+    res = prev.sum()
+    sign = -1.0
+    for r in range(2, n+1):
+        size = n-r+1
+        # prev[i] becomes p[i] * sum(prev[i+1:size+1]), going backwards to keep the running sum
+        running = 0.0
+        nxt = prev[size]
+        total = 0.0
+        for i in range(size-1, -1, -1):
+            running += nxt
+            nxt = prev[i]
+            prev[i] = running * p[i]
+            total += prev[i]
+        if total == 0.0:
+            break
+        res += sign * total
+        sign = -sign
+    return res
+
+
+@functools.lru_cache(maxsize=None)
+def _union_gu():
+    """
+    Builds the gufunc of Probability.unionProbabilityBatch on its first use, so importing Helper does not
+    pay for compiling or loading it.
+    
+    The gufunc is serial on purpose. A target='parallel' gufunc starts Numba's threading layer, which is
+    not fork-safe and keeps a process that forks a multiprocessing pool afterwards (e.g.
+    ContactNetwork.collect_statistics_parallel) from exiting. The fastmath flags leave out nnan and ninf,
+    since a probability of 1 gives log1p(-1) = -inf.
+    """
+    return numba.guvectorize([(numba.float32[:], numba.float32[:], numba.float32[:])], '(n),(n)->()',
+                             target='cpu', fastmath={'reassoc', 'contract', 'arcp', 'nsz', 'afn'},
+                             cache=True)(_union_row)
+
+
+def _union_row(p, mask, out):
+    """
+    Kernel of _union_gu, 1 - prod(1 - p*mask) for one row, computed as in Probability.unionProbability.
+    """
+    acc = np.float32(0.0)
+    for i in range(p.shape[0]):
+        acc += np.log1p(-p[i] * mask[i])
+    out[0] = -np.expm1(acc)
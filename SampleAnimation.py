@@ -17,7 +17,9 @@ from matplotlib.lines import Line2D
 fig, ax = plt.subplots()
 g = nx.random_lobster(10,.9,.9)
 
-weights = dict([(e, np.random.sample(1)[0]) for e in g.edges()])
+# The weights of all the edges are drawn in a single call
+edge_list = list(g.edges())
+weights = dict(zip(edge_list, np.random.sample(len(edge_list)).tolist()))
 nx.set_edge_attributes(g, weights, 'weight')
 
 legend_elements = [Line2D([0], [0], marker='o', color='w', lw=4, label='Susceptible', markersize=14, markerfacecolor='b'),
@@ -37,7 +39,8 @@ are supposed to correspond to the bottom left corner, it changes after plotting
 """
 text = ax.text(0,0,"Day 0")
 
-nx.draw_networkx_labels(g, pos, font_color="#ffffff")
+# The labels are animated with the nodes so they are redrawn on top of them when blitting
+labels = nx.draw_networkx_labels(g, pos, font_color="#ffffff")
 
 # Padding to center the graph in the axes
 ax.margins(0.1)
@@ -47,10 +50,9 @@ ax.margins(0.1)
 ax.legend(handles=legend_elements)
 
 cn = ContactNetwork(g)
-func = cn.get_animation_func([0,1], nodes, edges, text)
+func = cn.get_animation_func([0,1], nodes, edges, text, *labels.values())
 
-"""
-TODO: Setting blit=True for animation.FuncAnimation draws over labels after the first iteration.
-"""
-ani = animation.FuncAnimation(fig, func, np.arange(1, 200), interval=500)
+# The layout is computed once above, and with blit=True only the artists returned by func are redrawn
+# every frame instead of the whole figure
+ani = animation.FuncAnimation(fig, func, np.arange(1, 200), interval=500, blit=True)
 plt.show()
\ No newline at end of file